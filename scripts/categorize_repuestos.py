@@ -5,19 +5,32 @@ Uso:
   python scripts/categorize_repuestos.py --input repuestos.xlsx
   python scripts/categorize_repuestos.py --input repuestos.xlsx --output repuestos_categorizado.xlsx --batch-size 40
   python scripts/categorize_repuestos.py --input productos-20260211-2103.xlsx --carroceria-only
+  python scripts/categorize_repuestos.py --input repuestos.xlsx \
+      --tier "gpt-5-nano,batch=80,concurrency=4,tokens=2000,min_conf=0.8" --tier "gpt-5-mini,batch=30"
+  python scripts/categorize_repuestos.py --input repuestos_categorizado.xlsx \
+      --learn-prefixes prefijos.json --holdout otro_categorizado.xlsx
+  python scripts/categorize_repuestos.py --input repuestos.xlsx --prefix-index prefijos.json
+  python scripts/categorize_repuestos.py --input repuestos.xlsx --plan --concurrency 4 --rpm 500
+  python scripts/categorize_repuestos.py --input repuestos.xlsx --priority-file ventas_por_sku.csv --max-seconds 3600
 """
 
 from __future__ import annotations
 
 import argparse
+import csv
 import json
+import math
 import os
+import queue
 import re
 import sys
+import threading
 import time
 import unicodedata
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar
 from urllib import error as urlerror
 from urllib import request as urlrequest
 
@@ -41,6 +54,323 @@ CARROCERIA_CATEGORY = "Carroceria"
 MODEL_NAME = "gpt-5-mini"
 OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
 
+PREFIX_FIELDS: Tuple[str, ...] = ("sku", "referencia")
+PREFIX_MAX_DEPTH = 10
+PREFIX_MIN_LENGTH = 2
+PREFIX_DEFAULT_MIN_SUPPORT = 5
+PREFIX_DEFAULT_MIN_PURITY = 0.95
+
+STREAM_MAX_CONTINUATIONS = 3
+DEFAULT_MIN_CONFIDENCE = 0.8
+
+TELEMETRY_PATH = Path("categorize_repuestos.telemetry.jsonl")
+# Supuestos de --plan cuando no hay telemetria previa del modelo.
+DEFAULT_COMPLETION_TOKENS_PER_ROW = 40
+DEFAULT_SECONDS_PER_COMPLETION_TOKEN = 0.02
+DEFAULT_CALL_OVERHEAD_SECONDS = 1.5
+DEFAULT_TIER_RESOLVED_SHARE = 0.8
+
+# Espera maxima al final de la corrida por duplicados perdedores aun en curso.
+HEDGE_DRAIN_SECONDS = 30.0
+
+SKU_HEADERS = ["sku", "codigo", "cod", "codigo producto", "code"]
+# En orden de preferencia: las unidades van antes que `total`, que suele ser dinero.
+PRIORITY_VALUE_HEADERS = [
+    "prioridad",
+    "priority",
+    "ventas",
+    "vendidos",
+    "unidades",
+    "cantidad",
+    "qty",
+    "count",
+    "total",
+]
+# SaleItem no tiene sku: hay que unirlo con Product antes de exportar, p. ej.
+#   SELECT p.sku, SUM(si.qty) AS qty FROM "SaleItem" si
+#   JOIN "Product" p ON p.id = si."productId" WHERE p.sku IS NOT NULL GROUP BY p.sku;
+
+T = TypeVar("T")
+
+
+@dataclass
+class ModelTier:
+    """Un nivel de la cascada: modelo con su propio tamano de lote, concurrencia y limite de tokens.
+
+    `min_confidence` solo aplica a niveles intermedios: las filas con confianza menor
+    (o marcadas como dudosas) se escalan al siguiente nivel.
+    """
+
+    model: str
+    batch_size: int
+    concurrency: int
+    max_completion_tokens: int
+    min_confidence: float = DEFAULT_MIN_CONFIDENCE
+
+
+@dataclass
+class TierStats:
+    model: str
+    rows_in: int = 0
+    rows_resolved: int = 0
+    calls: int = 0
+    failed_batches: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    wall_seconds: float = 0.0
+    hedges: int = 0
+    hedge_wins: int = 0
+    call_seconds: List[float] = field(default_factory=list)
+    batch_seconds: List[float] = field(default_factory=list)
+    budget: Optional[RunBudget] = field(default=None, repr=False, compare=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def telemetry_record(self, mode: str) -> Dict[str, object]:
+        with self.lock:
+            return {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "mode": mode,
+                "model": self.model,
+                "rows_in": self.rows_in,
+                "rows_resolved": self.rows_resolved,
+                "calls": self.calls,
+                "batches": len(self.batch_seconds),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "call_seconds": round(sum(self.call_seconds), 3),
+                "batch_seconds": round(sum(self.batch_seconds), 3),
+            }
+
+    def start_call(self, prompt: str, max_completion_tokens: int) -> int:
+        """Reserva la llamada en el presupuesto antes de enviarla; lanza `BudgetExhausted` si no cabe."""
+        if self.budget is None:
+            return 0
+        return self.budget.reserve(estimate_tokens(prompt) + max_completion_tokens)
+
+    def budget_exhausted(self) -> bool:
+        return self.budget is not None and self.budget.exhausted()
+
+    def check_budget(self, partial: Optional[Dict[int, object]] = None) -> None:
+        """Lanza `BudgetExhausted` con lo ya clasificado si el presupuesto se agoto."""
+        if self.budget_exhausted():
+            raise BudgetExhausted(self.budget.reason or "presupuesto agotado", partial)  # type: ignore[union-attr]
+
+    def record_call(
+        self, seconds: Optional[float], usage: Optional[Dict[str, object]], reservation: int = 0
+    ) -> None:
+        """Registra una llamada. `seconds=None` cuenta la llamada sin afectar las latencias observadas."""
+        tokens = 0
+        with self.lock:
+            self.calls += 1
+            if seconds is not None:
+                self.call_seconds.append(seconds)
+            if usage:
+                tokens = int(usage.get("prompt_tokens") or 0) + int(usage.get("completion_tokens") or 0)
+                self.prompt_tokens += int(usage.get("prompt_tokens") or 0)
+                self.completion_tokens += int(usage.get("completion_tokens") or 0)
+        if self.budget is not None:
+            self.budget.settle(reservation, tokens)
+
+
+@dataclass
+class ModelTelemetry:
+    """Totales de corridas anteriores de un modelo, leidos del archivo de telemetria."""
+
+    runs: int = 0
+    rows_in: int = 0
+    rows_resolved: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    call_seconds: float = 0.0
+
+    def completion_tokens_per_row(self) -> Optional[float]:
+        return self.completion_tokens / self.rows_in if self.rows_in and self.completion_tokens else None
+
+    def seconds_per_completion_token(self) -> Optional[float]:
+        return self.call_seconds / self.completion_tokens if self.completion_tokens and self.call_seconds else None
+
+    def resolved_share(self) -> Optional[float]:
+        return self.rows_resolved / self.rows_in if self.rows_in else None
+
+
+class BudgetExhausted(Exception):
+    """El presupuesto de la corrida no admite mas llamadas.
+
+    `partial` lleva lo ya clasificado del lote interrumpido para que se guarde.
+    """
+
+    def __init__(self, reason: str, partial: Optional[Dict[int, object]] = None) -> None:
+        super().__init__(reason)
+        self.partial: Dict[int, object] = dict(partial or {})
+
+
+@dataclass
+class RunBudget:
+    """Limites de tiempo, llamadas y tokens de una corrida.
+
+    Cada llamada a la API (reintentos, mitades y copias de hedging incluidas) se reserva antes
+    de enviarse: cuenta como llamada desde ese momento y aparta los tokens del prompt mas
+    `max_completion_tokens`, que se cambian por el uso real al responder. Asi ni la
+    concurrencia ni los reintentos pasan de `--max-calls` o `--max-tokens`. Al agotarse no se
+    envia nada mas, lo ya respondido se guarda y las filas restantes quedan para otra corrida.
+    """
+
+    max_seconds: Optional[float] = None
+    max_calls: Optional[int] = None
+    max_tokens: Optional[int] = None
+    started: float = field(default_factory=time.monotonic)
+    calls_started: int = 0
+    tokens_spent: int = 0
+    tokens_reserved: int = 0
+    reason: Optional[str] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def _check_locked(self) -> None:
+        if self.reason is not None:
+            return
+        if self.max_seconds is not None and time.monotonic() - self.started >= self.max_seconds:
+            self.reason = f"--max-seconds {self.max_seconds:g}"
+        elif self.max_calls is not None and self.calls_started >= self.max_calls:
+            self.reason = f"--max-calls {self.max_calls}"
+        elif self.max_tokens is not None and self.tokens_spent >= self.max_tokens:
+            self.reason = f"--max-tokens {self.max_tokens}"
+
+    def exhausted(self) -> bool:
+        with self.lock:
+            self._check_locked()
+            return self.reason is not None
+
+    def calls_left(self) -> Optional[int]:
+        if self.max_calls is None:
+            return None
+        with self.lock:
+            return max(0, self.max_calls - self.calls_started)
+
+    def reserve(self, tokens: int) -> int:
+        with self.lock:
+            self._check_locked()
+            if (
+                self.reason is None
+                and self.max_tokens is not None
+                and self.tokens_spent + self.tokens_reserved + tokens > self.max_tokens
+            ):
+                # La llamada podria pasarse del limite: se corta aqui aunque otra mas chica cupiera.
+                self.reason = f"--max-tokens {self.max_tokens}"
+            if self.reason is not None:
+                raise BudgetExhausted(self.reason)
+            self.calls_started += 1
+            self.tokens_reserved += tokens
+            return tokens
+
+    def settle(self, reservation: int, tokens: int) -> None:
+        with self.lock:
+            self.tokens_reserved -= reservation
+            self.tokens_spent += tokens
+
+
+@dataclass
+class HedgePolicy:
+    """Envia un duplicado de una llamada lenta y se queda con la primera respuesta.
+
+    El retraso es el percentil `percentile` de las latencias ya observadas en el nivel
+    (nunca menor que `min_delay`); no se cubre nada hasta tener `min_samples` llamadas.
+    `max_hedges` limita el total de duplicados de toda la corrida.
+    """
+
+    percentile: float = 95.0
+    max_hedges: int = 20
+    min_delay: float = 2.0
+    min_samples: int = 5
+    hedges_sent: int = 0
+    threads: List[threading.Thread] = field(default_factory=list, repr=False, compare=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def start(self, target: Callable[[int], None], index: int) -> None:
+        thread = threading.Thread(target=target, args=(index,), daemon=True)
+        with self.lock:
+            self.threads = [alive for alive in self.threads if alive.is_alive()]
+            self.threads.append(thread)
+        thread.start()
+
+    def drain(self, timeout: float = HEDGE_DRAIN_SECONDS) -> None:
+        """Espera a las copias perdedoras aun en curso para que su uso entre en el resumen."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def delay_for(self, stats: TierStats) -> Optional[float]:
+        with self.lock:
+            if self.hedges_sent >= self.max_hedges:
+                return None
+        with stats.lock:
+            samples = list(stats.call_seconds)
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, percentile(samples, self.percentile))
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.hedges_sent >= self.max_hedges:
+                return False
+            self.hedges_sent += 1
+            return True
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def parse_tier_spec(spec: str, defaults: ModelTier) -> ModelTier:
+    """Interpreta `MODELO[,batch=N][,concurrency=N][,tokens=N][,min_conf=F]`."""
+    parts = [part.strip() for part in spec.split(",") if part.strip()]
+    if not parts or "=" in parts[0]:
+        raise ValueError(f"Nivel invalido (falta el modelo): {spec!r}")
+
+    tier = ModelTier(
+        model=parts[0],
+        batch_size=defaults.batch_size,
+        concurrency=defaults.concurrency,
+        max_completion_tokens=defaults.max_completion_tokens,
+        min_confidence=defaults.min_confidence,
+    )
+    for part in parts[1:]:
+        key, sep, value = part.partition("=")
+        key = normalize_text(key).replace("-", "_")
+        if not sep:
+            raise ValueError(f"Opcion de nivel invalida: {part!r}")
+        try:
+            if key in {"batch", "batch_size"}:
+                tier.batch_size = int(value)
+            elif key in {"concurrency", "workers"}:
+                tier.concurrency = int(value)
+            elif key in {"tokens", "max_tokens", "max_completion_tokens"}:
+                tier.max_completion_tokens = int(value)
+            elif key in {"min_conf", "min_confidence"}:
+                tier.min_confidence = float(value)
+            else:
+                raise ValueError(f"Opcion de nivel desconocida: {key!r}")
+        except ValueError as exc:
+            raise ValueError(f"Nivel invalido {spec!r}: {exc}") from exc
+
+    if tier.batch_size < 1:
+        raise ValueError(f"Nivel {tier.model}: batch debe ser >= 1")
+    if tier.concurrency < 1:
+        raise ValueError(f"Nivel {tier.model}: concurrency debe ser >= 1")
+    if tier.max_completion_tokens < 200:
+        raise ValueError(f"Nivel {tier.model}: tokens debe ser >= 200")
+    if not 0.0 <= tier.min_confidence <= 1.0:
+        raise ValueError(f"Nivel {tier.model}: min_conf debe estar entre 0 y 1")
+    return tier
+
 
 def normalize_text(value: str) -> str:
     value = value.strip().lower()
@@ -77,7 +407,7 @@ def resolve_header_indices(headers: Sequence[Optional[str]]) -> Tuple[int, int,
                 return idx
         return None
 
-    sku_idx = find_first(["sku", "codigo", "cod", "codigo producto", "code"])
+    sku_idx = find_first(SKU_HEADERS)
     description_idx = find_first(
         [
             "f_descripcion",
@@ -186,6 +516,257 @@ def keyword_fallback_carroceria(sku: str, description: str, reference: str) -> b
     return any(word in text for word in carroceria_words)
 
 
+def normalize_code(value: str) -> str:
+    return re.sub(r"[^0-9A-Z]", "", normalize_text(value).upper())
+
+
+def parse_priority(value: object) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().replace(",", ""))
+    except ValueError:
+        return None
+
+
+def load_priority_file(path: Path) -> Dict[str, float]:
+    """Lee un CSV o Excel con sku y un valor (p. ej. unidades vendidas por sku) y suma por sku.
+
+    La columna de valor es la primera de `PRIORITY_VALUE_HEADERS` presente; si no hay ninguna,
+    la unica otra columna cuyos valores sean numericos.
+    """
+    if path.suffix.lower() in {".xlsx", ".xlsm"}:
+        wb = load_workbook(filename=str(path), read_only=True)
+        rows = [list(values) for values in wb.active.iter_rows(values_only=True)]
+        wb.close()
+    else:
+        text = path.read_text(encoding="utf-8-sig")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = [list(values) for values in csv.reader(text.splitlines(), dialect)]
+
+    if not rows:
+        raise ValueError(f"{path} esta vacio")
+    headers = [normalize_text(str(col or "")) for col in rows[0]]
+    sku_col = next((idx for idx, name in enumerate(headers) if name in SKU_HEADERS), None)
+    if sku_col is None:
+        hint = ""
+        if "productid" in headers:
+            hint = " Un export de SaleItem debe unirse con Product para obtener Product.sku."
+        raise ValueError(f"{path} no tiene columna sku. Encabezados detectados: {rows[0]}.{hint}")
+
+    value_col = next((headers.index(name) for name in PRIORITY_VALUE_HEADERS if name in headers), None)
+    if value_col is None:
+        numeric_cols = [
+            idx
+            for idx in range(len(headers))
+            if idx != sku_col
+            and any(idx < len(values) and values[idx] not in (None, "") for values in rows[1:])
+            and all(
+                parse_priority(values[idx]) is not None
+                for values in rows[1:]
+                if idx < len(values) and values[idx] not in (None, "")
+            )
+        ]
+        if len(numeric_cols) != 1:
+            raise ValueError(
+                f"{path} no tiene una columna de valor reconocible "
+                f"({', '.join(PRIORITY_VALUE_HEADERS)}). Encabezados detectados: {rows[0]}"
+            )
+        value_col = numeric_cols[0]
+
+    priorities: Dict[str, float] = {}
+    for values in rows[1:]:
+        if max(sku_col, value_col) >= len(values):
+            continue
+        sku = normalize_code(str(values[sku_col] or ""))
+        value = parse_priority(values[value_col])
+        if sku and value is not None:
+            priorities[sku] = priorities.get(sku, 0.0) + value
+    return priorities
+
+
+def prioritize_rows(
+    cell_value: Callable[[int, int], object],
+    headers: Sequence[Optional[str]],
+    rows: Sequence[Dict[str, str]],
+    priority_column: Optional[str],
+    priorities: Optional[Dict[str, float]],
+) -> List[Dict[str, str]]:
+    """Ordena las filas pendientes de mayor a menor prioridad.
+
+    La prioridad sale de `priority_column` en la hoja (leida con `cell_value(fila, columna)`) o,
+    si no hay valor, de `priorities` por sku. Las filas sin prioridad quedan al final en el orden
+    de la hoja.
+    """
+    if not priority_column and not priorities:
+        return list(rows)
+
+    priority_col = None
+    if priority_column:
+        wanted = normalize_text(priority_column)
+        for idx, col in enumerate(headers, start=1):
+            if normalize_text(str(col or "")) == wanted:
+                priority_col = idx
+                break
+        if priority_col is None:
+            raise ValueError(
+                f"No se encontro la columna de prioridad {priority_column!r}. "
+                f"Encabezados detectados: {[str(h or '') for h in headers]}"
+            )
+
+    def sort_key(item: Dict[str, str]) -> float:
+        value = None
+        if priority_col is not None:
+            value = parse_priority(cell_value(int(item["row"]), priority_col))
+        if value is None and priorities:
+            value = priorities.get(normalize_code(item["sku"]))
+        return -value if value is not None else math.inf
+
+    return sorted(rows, key=sort_key)
+
+
+@dataclass
+class PrefixIndex:
+    """Tries de prefijos de sku/referencia con la distribucion de categorias de cada prefijo.
+
+    Cada nodo es `{"n": {categoria: conteo}, "k": {caracter: nodo}}`. Solo se conservan
+    prefijos con al menos `min_support` filas, asi que el archivo queda compacto.
+    """
+
+    min_support: int
+    min_purity: float
+    max_depth: int = PREFIX_MAX_DEPTH
+    tries: Dict[str, Dict[str, dict]] = field(default_factory=dict)
+
+    @classmethod
+    def build(
+        cls,
+        rows: Iterable[Dict[str, str]],
+        min_support: int,
+        min_purity: float,
+        max_depth: int = PREFIX_MAX_DEPTH,
+    ) -> "PrefixIndex":
+        index = cls(min_support=min_support, min_purity=min_purity, max_depth=max_depth)
+        index.tries = {name: {"n": {}} for name in PREFIX_FIELDS}
+        for row in rows:
+            category = row["categoria"]
+            for name in PREFIX_FIELDS:
+                node = index.tries[name]
+                node["n"][category] = node["n"].get(category, 0) + 1
+                for char in normalize_code(row.get(name, ""))[:max_depth]:
+                    node = node.setdefault("k", {}).setdefault(char, {"n": {}})
+                    node["n"][category] = node["n"].get(category, 0) + 1
+        for trie in index.tries.values():
+            prune_prefix_node(trie, min_support)
+        return index
+
+    @classmethod
+    def load(cls, path: Path) -> "PrefixIndex":
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return cls(
+            min_support=int(data["min_support"]),
+            min_purity=float(data["min_purity"]),
+            max_depth=int(data.get("max_depth", PREFIX_MAX_DEPTH)),
+            tries=data["tries"],
+        )
+
+    def save(self, path: Path) -> None:
+        data = {
+            "min_support": self.min_support,
+            "min_purity": self.min_purity,
+            "max_depth": self.max_depth,
+            "tries": self.tries,
+        }
+        path.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+
+    def node_count(self) -> int:
+        def count(node: dict) -> int:
+            return 1 + sum(count(child) for child in node.get("k", {}).values())
+
+        return sum(count(trie) for trie in self.tries.values())
+
+    def lookup(self, name: str, value: str) -> Optional[Tuple[str, float, int]]:
+        """Devuelve (categoria, pureza, soporte) del prefijo puro mas largo de `value`, si existe."""
+        node = self.tries.get(name)
+        best: Optional[Tuple[str, float, int]] = None
+        for depth, char in enumerate(normalize_code(value)[: self.max_depth], start=1):
+            node = (node or {}).get("k", {}).get(char)
+            if node is None:
+                break
+            support = sum(node["n"].values())
+            if depth < PREFIX_MIN_LENGTH or support < self.min_support:
+                continue
+            category, count = max(node["n"].items(), key=lambda pair: pair[1])
+            purity = count / support
+            if purity >= self.min_purity:
+                best = (category, purity, support)
+        return best
+
+    def predict(self, sku: str, reference: str) -> Optional[str]:
+        matches = [
+            match
+            for match in (self.lookup("sku", sku), self.lookup("referencia", reference))
+            if match is not None
+        ]
+        if not matches:
+            return None
+        return max(matches, key=lambda match: (match[1], match[2]))[0]
+
+
+def prune_prefix_node(node: dict, min_support: int) -> None:
+    children = node.get("k", {})
+    for char in list(children):
+        child = children[char]
+        if sum(child["n"].values()) < min_support:
+            del children[char]
+        else:
+            prune_prefix_node(child, min_support)
+    if not children:
+        node.pop("k", None)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimacion local de tokens (~4 caracteres por token), suficiente para planificar."""
+    return max(1, (len(text) + 3) // 4)
+
+
+def append_telemetry(path: Path, mode: str, tier_stats: Sequence[TierStats]) -> None:
+    try:
+        with path.open("a", encoding="utf-8") as handle:
+            for stats in tier_stats:
+                handle.write(json.dumps(stats.telemetry_record(mode), ensure_ascii=False) + "\n")
+    except OSError as exc:
+        print(f"Aviso: no se pudo escribir telemetria en {path}: {exc}", file=sys.stderr)
+
+
+def load_telemetry(path: Path, mode: str) -> Dict[str, ModelTelemetry]:
+    summary: Dict[str, ModelTelemetry] = {}
+    if not path.exists():
+        return summary
+
+    for raw_line in path.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(raw_line)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(record, dict) or record.get("mode") != mode:
+            continue
+        totals = summary.setdefault(str(record.get("model", "")), ModelTelemetry())
+        totals.runs += 1
+        totals.rows_in += int(record.get("rows_in") or 0)
+        totals.rows_resolved += int(record.get("rows_resolved") or 0)
+        totals.calls += int(record.get("calls") or 0)
+        totals.prompt_tokens += int(record.get("prompt_tokens") or 0)
+        totals.completion_tokens += int(record.get("completion_tokens") or 0)
+        totals.call_seconds += float(record.get("call_seconds") or 0.0)
+    return summary
+
+
 def extract_json_from_text(text: str) -> str:
     text = text.strip()
     if text.startswith("```"):
@@ -195,9 +776,15 @@ def extract_json_from_text(text: str) -> str:
     return text
 
 
-def call_openai_chat(api_key: str, prompt: str, max_completion_tokens: int = 2600) -> str:
-    payload = {
-        "model": MODEL_NAME,
+def build_chat_request(
+    api_key: str,
+    prompt: str,
+    max_completion_tokens: int,
+    model: str,
+    stream: bool = False,
+) -> urlrequest.Request:
+    payload: Dict[str, object] = {
+        "model": model,
         "messages": [
             {
                 "role": "system",
@@ -210,8 +797,11 @@ def call_openai_chat(api_key: str, prompt: str, max_completion_tokens: int = 260
         ],
         "max_completion_tokens": max_completion_tokens,
     }
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
 
-    req = urlrequest.Request(
+    return urlrequest.Request(
         OPENAI_CHAT_URL,
         data=json.dumps(payload).encode("utf-8"),
         headers={
@@ -221,14 +811,37 @@ def call_openai_chat(api_key: str, prompt: str, max_completion_tokens: int = 260
         method="POST",
     )
 
+
+def call_openai_chat(
+    api_key: str,
+    prompt: str,
+    max_completion_tokens: int = 2600,
+    model: str = MODEL_NAME,
+    stats: Optional[TierStats] = None,
+    cancel: Optional[threading.Event] = None,
+) -> str:
+    req = build_chat_request(api_key, prompt, max_completion_tokens, model)
+    reservation = stats.start_call(prompt, max_completion_tokens) if stats is not None else 0
+
+    started = time.monotonic()
+    seconds: Optional[float] = None
+    usage: Optional[Dict[str, object]] = None
     try:
         with urlrequest.urlopen(req, timeout=120) as response:
             body = response.read().decode("utf-8")
+        data = json.loads(body)
+        seconds = time.monotonic() - started
+        usage = data.get("usage")
     except urlerror.HTTPError as exc:
         details = exc.read().decode("utf-8", errors="replace")
         raise RuntimeError(f"HTTP {exc.code}: {details[:800]}") from exc
+    finally:
+        if stats is not None:
+            stats.record_call(seconds, usage, reservation)
 
-    data = json.loads(body)
+    # Sin streaming la copia perdedora ya se genero y se cobro: se registra y luego se descarta.
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError("Llamada cancelada: otra copia respondio primero")
     choices = data.get("choices") or []
     if not choices:
         raise RuntimeError(f"Respuesta sin choices: {body[:500]}")
@@ -244,35 +857,282 @@ def call_openai_chat(api_key: str, prompt: str, max_completion_tokens: int = 260
     return content
 
 
-def classify_batch(
+def call_openai_chat_stream(
     api_key: str,
-    rows: Sequence[Dict[str, str]],
-    retries: int,
-    retry_base_sleep: float,
+    prompt: str,
     max_completion_tokens: int,
-) -> Dict[int, str]:
+    model: str,
+    on_text: Callable[[str], None],
+    stats: Optional[TierStats] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Tuple[str, str]:
+    """Llama en modo streaming y pasa cada fragmento a `on_text` segun llega.
+
+    Devuelve (contenido, finish_reason). A diferencia de `call_openai_chat`, una respuesta
+    truncada (`finish_reason=length`) no es un error: quien llama decide si continuar.
+    """
+    req = build_chat_request(api_key, prompt, max_completion_tokens, model, stream=True)
+    reservation = stats.start_call(prompt, max_completion_tokens) if stats is not None else 0
+
+    started = time.monotonic()
+    seconds: Optional[float] = None
+    parts: List[str] = []
+    finish_reason = ""
+    usage: Optional[Dict[str, object]] = None
+    try:
+        with urlrequest.urlopen(req, timeout=120) as response:
+            for raw_line in response:
+                if cancel is not None and cancel.is_set():
+                    # El servidor no envia el uso de un stream cortado: se estima lo generado.
+                    usage = {
+                        "prompt_tokens": estimate_tokens(prompt),
+                        "completion_tokens": estimate_tokens("".join(parts)) if parts else 0,
+                    }
+                    raise RuntimeError("Llamada cancelada: otra copia respondio primero")
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data_text = line[len("data:") :].strip()
+                if data_text == "[DONE]":
+                    break
+                chunk = json.loads(data_text)
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                for choice in chunk.get("choices") or []:
+                    text = (choice.get("delta") or {}).get("content")
+                    if text:
+                        parts.append(text)
+                        on_text(text)
+                    if choice.get("finish_reason"):
+                        finish_reason = str(choice["finish_reason"])
+        seconds = time.monotonic() - started
+    except urlerror.HTTPError as exc:
+        details = exc.read().decode("utf-8", errors="replace")
+        raise RuntimeError(f"HTTP {exc.code}: {details[:800]}") from exc
+    finally:
+        if stats is not None:
+            stats.record_call(seconds, usage, reservation)
+
+    content = "".join(parts)
+    if not content and finish_reason != "length":
+        raise RuntimeError(f"Respuesta sin contenido (finish_reason={finish_reason or 'desconocido'})")
+    return content, finish_reason
+
+
+def run_hedged(
+    call: Callable[[Optional[threading.Event]], T],
+    stats: Optional[TierStats],
+    hedge: Optional[HedgePolicy],
+) -> T:
+    """Ejecuta `call(cancel)` y, si tarda mas que el retraso de `hedge`, lanza un duplicado.
+
+    Gana la primera copia que responda bien; a la otra se le marca la cancelacion y su
+    resultado se descarta. Sin streaming urllib no permite abortarla, asi que termina y su
+    uso se registra igual; en streaming se corta en el siguiente fragmento y se registra lo
+    estimado hasta ese punto.
+    """
+    delay = hedge.delay_for(stats) if hedge is not None and stats is not None else None
+    if delay is None:
+        return call(None)
+
+    results: "queue.Queue[Tuple[int, Optional[T], Optional[Exception]]]" = queue.Queue()
+    cancel = threading.Event()
+
+    def attempt(index: int) -> None:
+        try:
+            results.put((index, call(cancel), None))
+        except Exception as exc:
+            results.put((index, None, exc))
+
+    hedge.start(attempt, 0)  # type: ignore[union-attr]
+    launched = 1
+    try:
+        index, value, exc = results.get(timeout=delay)
+    except queue.Empty:
+        # La copia tambien reserva su llamada; con el presupuesto agotado no se lanza.
+        if hedge is not None and not (stats.budget is not None and stats.budget.exhausted()) and hedge.try_acquire():
+            hedge.start(attempt, 1)
+            launched = 2
+            with stats.lock:
+                stats.hedges += 1
+        index, value, exc = results.get()
+
+    if exc is not None and launched == 2:
+        index, value, exc = results.get()
+    cancel.set()
+
+    if exc is not None:
+        raise exc
+    if index == 1:
+        with stats.lock:
+            stats.hedge_wins += 1
+    return value  # type: ignore[return-value]
+
+
+def call_openai_chat_hedged(
+    api_key: str,
+    prompt: str,
+    max_completion_tokens: int,
+    model: str,
+    stats: Optional[TierStats],
+    hedge: Optional[HedgePolicy],
+) -> str:
+    return run_hedged(
+        lambda cancel: call_openai_chat(
+            api_key=api_key,
+            prompt=prompt,
+            max_completion_tokens=max_completion_tokens,
+            model=model,
+            stats=stats,
+            cancel=cancel,
+        ),
+        stats,
+        hedge,
+    )
+
+
+class StreamingItemParser:
+    """Extrae cada objeto completo de la lista `items` a medida que llega el texto JSON."""
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.pos = 0
+        self.in_items = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = 0
+
+    def feed(self, text: str) -> List[Dict[str, object]]:
+        self.buffer += text
+        out: List[Dict[str, object]] = []
+        if self.finished:
+            return out
+        if not self.in_items:
+            match = re.search(r'"items"\s*:\s*\[', self.buffer)
+            if not match:
+                return out
+            self.in_items = True
+            self.pos = match.end()
+
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        item = json.loads(self.buffer[self.start : self.pos + 1])
+                    except json.JSONDecodeError:
+                        item = None
+                    if isinstance(item, dict):
+                        out.append(item)
+            elif ch == "]" and self.depth == 0:
+                self.finished = True
+                break
+            self.pos += 1
+        return out
+
+
+def build_category_prompt(rows: Sequence[Dict[str, str]], ask_confidence: bool) -> str:
     categories_text = "\n".join(f"- {c}" for c in CATEGORIES)
-    prompt = (
+    if ask_confidence:
+        doubt_rule = (
+            "4) Incluye en \"p\" tu confianza entre 0 y 1. "
+            "Si no estas seguro de la categoria, responde \"c\":\"?\".\n\n"
+        )
+        output_format = '{"items":[{"r":123,"c":"Motor","p":0.95}]}\n\n'
+    else:
+        doubt_rule = "4) Si hay duda, elige la categoria mas probable por descripcion/referencia.\n\n"
+        output_format = '{"items":[{"r":123,"c":"Motor"}]}\n\n'
+
+    return (
         "Clasifica cada producto en una sola categoria usando exclusivamente estas categorias:\n"
         f"{categories_text}\n\n"
         "Reglas:\n"
         "1) Responde SOLO JSON valido (sin markdown).\n"
         "2) Debes devolver exactamente un resultado por cada item.\n"
         "3) No inventes nuevas categorias.\n"
-        "4) Si hay duda, elige la categoria mas probable por descripcion/referencia.\n\n"
+        f"{doubt_rule}"
         "Formato exacto de salida:\n"
-        '{"items":[{"r":123,"c":"Motor"}]}\n\n'
+        f"{output_format}"
         "Items a clasificar:\n"
         f"{json.dumps(rows, ensure_ascii=False)}"
     )
 
+
+def parse_confidence(value: object) -> float:
+    try:
+        return float(value)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def accept_category_item(item: object, min_confidence: Optional[float]) -> Optional[Tuple[int, str]]:
+    if not isinstance(item, dict):
+        return None
+    row = item.get("r", item.get("row"))
+    category = canonicalize_category(str(item.get("c", item.get("categoria", ""))))
+    if min_confidence is not None and parse_confidence(item.get("p")) < min_confidence:
+        return None
+    if isinstance(row, int) and category:
+        return row, category
+    return None
+
+
+def classify_batch(
+    api_key: str,
+    rows: Sequence[Dict[str, str]],
+    retries: int,
+    retry_base_sleep: float,
+    max_completion_tokens: int,
+    model: str = MODEL_NAME,
+    min_confidence: Optional[float] = None,
+    stats: Optional[TierStats] = None,
+    hedge: Optional[HedgePolicy] = None,
+    stream: bool = False,
+    on_item: Optional[Callable[[int, str], None]] = None,
+) -> Dict[int, str]:
+    """Clasifica un lote. Con `min_confidence` se omiten las filas dudosas para escalarlas."""
+    if stream:
+        return classify_batch_streaming(
+            api_key=api_key,
+            rows=rows,
+            retries=retries,
+            retry_base_sleep=retry_base_sleep,
+            max_completion_tokens=max_completion_tokens,
+            model=model,
+            min_confidence=min_confidence,
+            stats=stats,
+            hedge=hedge,
+            on_item=on_item,
+        )
+
+    prompt = build_category_prompt(rows, ask_confidence=min_confidence is not None)
+
     last_error: Optional[Exception] = None
     for attempt in range(1, retries + 1):
         try:
-            raw = call_openai_chat(
+            raw = call_openai_chat_hedged(
                 api_key=api_key,
                 prompt=prompt,
                 max_completion_tokens=max_completion_tokens,
+                model=model,
+                stats=stats,
+                hedge=hedge,
             )
             parsed = json.loads(extract_json_from_text(raw))
             items = parsed.get("items")
@@ -281,32 +1141,126 @@ def classify_batch(
 
             result: Dict[int, str] = {}
             for item in items:
-                if not isinstance(item, dict):
-                    continue
-                row = item.get("r", item.get("row"))
-                category = canonicalize_category(str(item.get("c", item.get("categoria", ""))))
-                if isinstance(row, int) and category:
-                    result[row] = category
+                accepted = accept_category_item(item, min_confidence)
+                if accepted is not None:
+                    result[accepted[0]] = accepted[1]
 
             return result
         except (json.JSONDecodeError, ValueError, RuntimeError, urlerror.HTTPError, urlerror.URLError) as exc:
             last_error = exc
-            if attempt >= retries:
+            if attempt >= retries or (stats is not None and stats.budget_exhausted()):
                 break
             sleep_seconds = retry_base_sleep * attempt
             time.sleep(sleep_seconds)
 
+    if stats is not None:
+        stats.check_budget()
     raise RuntimeError(f"No se pudo clasificar lote despues de {retries} intentos: {last_error}")
 
 
-def classify_batch_carroceria(
+def classify_batch_streaming(
     api_key: str,
     rows: Sequence[Dict[str, str]],
     retries: int,
     retry_base_sleep: float,
     max_completion_tokens: int,
-) -> Dict[int, bool]:
-    prompt = (
+    model: str,
+    min_confidence: Optional[float],
+    stats: Optional[TierStats],
+    hedge: Optional[HedgePolicy],
+    on_item: Optional[Callable[[int, str], None]],
+) -> Dict[int, str]:
+    """Variante en streaming de `classify_batch`.
+
+    Cada item se entrega a `on_item` en cuanto llega completo. Si la respuesta se trunca
+    (`finish_reason=length`) o falla, el siguiente intento solo pide las filas aun sin respuesta;
+    una fila respondida como dudosa cuenta como respondida y no se vuelve a pedir.
+    """
+    batch_rows = {int(row["row"]) for row in rows}
+    result: Dict[int, str] = {}
+    answered: Set[int] = set()
+    result_lock = threading.Lock()
+    closed = threading.Event()
+
+    def make_on_text() -> Callable[[str], None]:
+        parser = StreamingItemParser()
+
+        def on_text(text: str) -> None:
+            for item in parser.feed(text):
+                row = item.get("r", item.get("row"))
+                if not isinstance(row, int) or row not in batch_rows:
+                    continue
+                accepted = accept_category_item(item, min_confidence)
+                with result_lock:
+                    if closed.is_set() or row in answered:
+                        continue
+                    answered.add(row)
+                    if accepted is None:
+                        continue
+                    result[row] = accepted[1]
+                if on_item is not None:
+                    on_item(*accepted)
+
+        return on_text
+
+    def finish() -> Dict[int, str]:
+        # Una copia cubierta que siga transmitiendo no debe agregar filas despues de cerrar el lote.
+        with result_lock:
+            closed.set()
+            return dict(result)
+
+    last_error: Optional[Exception] = None
+    attempt = 0
+    continuations = 0
+    while True:
+        with result_lock:
+            remaining = [row for row in rows if int(row["row"]) not in answered]
+            answered_before = len(answered)
+        if not remaining:
+            return finish()
+        prompt = build_category_prompt(remaining, ask_confidence=min_confidence is not None)
+        try:
+            content, finish_reason = run_hedged(
+                lambda cancel: call_openai_chat_stream(
+                    api_key=api_key,
+                    prompt=prompt,
+                    max_completion_tokens=max_completion_tokens,
+                    model=model,
+                    on_text=make_on_text(),
+                    stats=stats,
+                    cancel=cancel,
+                ),
+                stats,
+                hedge,
+            )
+            if finish_reason != "length":
+                if len(answered) == answered_before and '"items"' not in content:
+                    raise ValueError("La respuesta no contiene 'items' como lista")
+                return finish()
+            if len(answered) == answered_before:
+                raise RuntimeError("Respuesta truncada por limite de tokens (finish_reason=length) sin avance")
+            if continuations >= STREAM_MAX_CONTINUATIONS:
+                raise RuntimeError(
+                    f"Respuesta truncada por limite de tokens tras {STREAM_MAX_CONTINUATIONS} continuaciones"
+                )
+            continuations += 1
+        except BudgetExhausted:
+            break
+        except (json.JSONDecodeError, ValueError, RuntimeError, urlerror.HTTPError, urlerror.URLError) as exc:
+            last_error = exc
+            attempt += 1
+            if attempt >= retries or (stats is not None and stats.budget_exhausted()):
+                break
+            time.sleep(retry_base_sleep * attempt)
+
+    partial = finish()
+    if stats is not None:
+        stats.check_budget(partial)  # type: ignore[arg-type]
+    raise RuntimeError(f"No se pudo clasificar lote despues de {retries} intentos: {last_error}")
+
+
+def build_carroceria_prompt(rows: Sequence[Dict[str, str]]) -> str:
+    return (
         "Determina si cada producto pertenece a la categoria Carroceria.\n"
         "Responde SOLO JSON valido (sin markdown), un item por fila.\n"
         "Formato exacto:\n"
@@ -316,13 +1270,29 @@ def classify_batch_carroceria(
         f"{json.dumps(rows, ensure_ascii=False)}"
     )
 
+
+def classify_batch_carroceria(
+    api_key: str,
+    rows: Sequence[Dict[str, str]],
+    retries: int,
+    retry_base_sleep: float,
+    max_completion_tokens: int,
+    model: str = MODEL_NAME,
+    stats: Optional[TierStats] = None,
+    hedge: Optional[HedgePolicy] = None,
+) -> Dict[int, bool]:
+    prompt = build_carroceria_prompt(rows)
+
     last_error: Optional[Exception] = None
     for attempt in range(1, retries + 1):
         try:
-            raw = call_openai_chat(
+            raw = call_openai_chat_hedged(
                 api_key=api_key,
                 prompt=prompt,
                 max_completion_tokens=max_completion_tokens,
+                model=model,
+                stats=stats,
+                hedge=hedge,
             )
             parsed = json.loads(extract_json_from_text(raw))
             items = parsed.get("items")
@@ -340,10 +1310,12 @@ def classify_batch_carroceria(
             return result
         except (json.JSONDecodeError, ValueError, RuntimeError, urlerror.HTTPError, urlerror.URLError) as exc:
             last_error = exc
-            if attempt >= retries:
+            if attempt >= retries or (stats is not None and stats.budget_exhausted()):
                 break
             time.sleep(retry_base_sleep * attempt)
 
+    if stats is not None:
+        stats.check_budget()
     raise RuntimeError(f"No se pudo clasificar lote de carroceria despues de {retries} intentos: {last_error}")
 
 
@@ -354,7 +1326,19 @@ def classify_batch_resilient(
     retry_base_sleep: float,
     max_completion_tokens: int,
     progress: tqdm,
+    model: str = MODEL_NAME,
+    stats: Optional[TierStats] = None,
+    hedge: Optional[HedgePolicy] = None,
+    stream: bool = False,
+    on_item: Optional[Callable[[int, str], None]] = None,
 ) -> Dict[int, str]:
+    streamed: Dict[int, str] = {}
+
+    def remember_item(row: int, category: str) -> None:
+        streamed[row] = category
+        if on_item is not None:
+            on_item(row, category)
+
     try:
         return classify_batch(
             api_key=api_key,
@@ -362,13 +1346,27 @@ def classify_batch_resilient(
             retries=retries,
             retry_base_sleep=retry_base_sleep,
             max_completion_tokens=max_completion_tokens,
+            model=model,
+            stats=stats,
+            hedge=hedge,
+            stream=stream,
+            on_item=remember_item if stream else None,
         )
+    except BudgetExhausted as exc:
+        raise BudgetExhausted(str(exc), {**streamed, **exc.partial}) from None
     except Exception as exc:
+        if streamed:
+            rows = [row for row in rows if int(row["row"]) not in streamed]
+            if not rows:
+                return dict(streamed)
+        # Sin presupuesto no se divide ni se usa fallback: las filas quedan para otra corrida.
+        if stats is not None:
+            stats.check_budget(streamed)  # type: ignore[arg-type]
         if len(rows) == 1:
             progress.write(
                 f"Aviso: fila {rows[0].get('row')} no pudo clasificarse con IA; se usara fallback. Motivo: {exc}"
             )
-            return {}
+            return dict(streamed)
 
         midpoint = len(rows) // 2
         left = rows[:midpoint]
@@ -378,27 +1376,26 @@ def classify_batch_resilient(
             f"Aviso: lote de {len(rows)} filas fallo. Se reintenta dividiendo en {len(left)} + {len(right)}."
         )
 
-        out: Dict[int, str] = {}
-        out.update(
-            classify_batch_resilient(
-                api_key=api_key,
-                rows=left,
-                retries=retries,
-                retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
-                progress=progress,
-            )
-        )
-        out.update(
-            classify_batch_resilient(
-                api_key=api_key,
-                rows=right,
-                retries=retries,
-                retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
-                progress=progress,
-            )
-        )
+        out: Dict[int, str] = dict(streamed)
+        for half in (left, right):
+            try:
+                out.update(
+                    classify_batch_resilient(
+                        api_key=api_key,
+                        rows=half,
+                        retries=retries,
+                        retry_base_sleep=retry_base_sleep,
+                        max_completion_tokens=max_completion_tokens,
+                        progress=progress,
+                        model=model,
+                        stats=stats,
+                        hedge=hedge,
+                        stream=stream,
+                        on_item=on_item,
+                    )
+                )
+            except BudgetExhausted as exhausted:
+                raise BudgetExhausted(str(exhausted), {**out, **exhausted.partial}) from None
         return out
 
 
@@ -409,6 +1406,9 @@ def classify_batch_carroceria_resilient(
     retry_base_sleep: float,
     max_completion_tokens: int,
     progress: tqdm,
+    model: str = MODEL_NAME,
+    stats: Optional[TierStats] = None,
+    hedge: Optional[HedgePolicy] = None,
 ) -> Dict[int, bool]:
     try:
         return classify_batch_carroceria(
@@ -417,8 +1417,15 @@ def classify_batch_carroceria_resilient(
             retries=retries,
             retry_base_sleep=retry_base_sleep,
             max_completion_tokens=max_completion_tokens,
+            model=model,
+            stats=stats,
+            hedge=hedge,
         )
+    except BudgetExhausted:
+        raise
     except Exception as exc:
+        if stats is not None:
+            stats.check_budget()
         if len(rows) == 1:
             progress.write(
                 f"Aviso: fila {rows[0].get('row')} no pudo clasificarse (Carroceria) con IA; se usara fallback. Motivo: {exc}"
@@ -433,39 +1440,175 @@ def classify_batch_carroceria_resilient(
         )
 
         out: Dict[int, bool] = {}
-        out.update(
-            classify_batch_carroceria_resilient(
-                api_key=api_key,
-                rows=left,
-                retries=retries,
-                retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
-                progress=progress,
-            )
-        )
-        out.update(
-            classify_batch_carroceria_resilient(
-                api_key=api_key,
-                rows=right,
-                retries=retries,
-                retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
-                progress=progress,
-            )
-        )
+        for half in (left, right):
+            try:
+                out.update(
+                    classify_batch_carroceria_resilient(
+                        api_key=api_key,
+                        rows=half,
+                        retries=retries,
+                        retry_base_sleep=retry_base_sleep,
+                        max_completion_tokens=max_completion_tokens,
+                        progress=progress,
+                        model=model,
+                        stats=stats,
+                        hedge=hedge,
+                    )
+                )
+            except BudgetExhausted as exhausted:
+                raise BudgetExhausted(str(exhausted), {**out, **exhausted.partial}) from None
         return out
 
 
+def iter_tier_batches(
+    api_key: str,
+    tier: ModelTier,
+    rows: Sequence[Dict[str, str]],
+    is_last: bool,
+    retries: int,
+    retry_base_sleep: float,
+    stats: TierStats,
+    progress: tqdm,
+    hedge: Optional[HedgePolicy] = None,
+    stream: bool = False,
+    budget: Optional[RunBudget] = None,
+) -> Iterator[Tuple[Sequence[Dict[str, str]], Dict[int, str], bool]]:
+    """Ejecuta los lotes de un nivel con `tier.concurrency` hilos.
+
+    Entrega `(filas, clasificadas, lote_terminado)`. Cada lote llega al terminar con
+    `lote_terminado=True`; en streaming ademas llega cada fila suelta en cuanto la IA la
+    responde, con `lote_terminado=False`, para escribirla sin esperar al resto del lote.
+
+    El ultimo nivel divide los lotes fallidos como `classify_batch_resilient`; los niveles
+    intermedios piden confianza y, si un lote falla, lo escalan completo al siguiente nivel.
+    Los lotes se envian a medida que hay hilos libres y solo mientras `budget` no se agote;
+    un lote cortado por el presupuesto entrega solo las filas que alcanzo a clasificar.
+    """
+    rows_by_number = {int(item["row"]): item for item in rows}
+    streamed_items: "queue.Queue[Tuple[int, str]]" = queue.Queue()
+    on_item = (lambda row, category: streamed_items.put((row, category))) if stream else None
+
+    def run_batch(batch: Sequence[Dict[str, str]]) -> Tuple[Sequence[Dict[str, str]], Dict[int, str]]:
+        started = time.monotonic()
+        try:
+            if is_last:
+                classified = classify_batch_resilient(
+                    api_key=api_key,
+                    rows=batch,
+                    retries=retries,
+                    retry_base_sleep=retry_base_sleep,
+                    max_completion_tokens=tier.max_completion_tokens,
+                    progress=progress,
+                    model=tier.model,
+                    stats=stats,
+                    hedge=hedge,
+                    stream=stream,
+                    on_item=on_item,
+                )
+            else:
+                try:
+                    classified = classify_batch(
+                        api_key=api_key,
+                        rows=batch,
+                        retries=retries,
+                        retry_base_sleep=retry_base_sleep,
+                        max_completion_tokens=tier.max_completion_tokens,
+                        model=tier.model,
+                        min_confidence=tier.min_confidence,
+                        stats=stats,
+                        hedge=hedge,
+                        stream=stream,
+                        on_item=on_item,
+                    )
+                except BudgetExhausted:
+                    raise
+                except Exception as exc:
+                    with stats.lock:
+                        stats.failed_batches += 1
+                    progress.write(
+                        f"Aviso: lote de {len(batch)} filas fallo con {tier.model}; se escala al siguiente nivel. Motivo: {exc}"
+                    )
+                    classified = {}
+        except BudgetExhausted as exc:
+            # Las filas sin respuesta no se escalan ni van a fallback: siguen pendientes.
+            classified = {row: str(category) for row, category in exc.partial.items()}
+            batch = [item for item in batch if int(item["row"]) in classified]
+        with stats.lock:
+            # Solo cuentan las filas enviadas: la telemetria de un nivel cortado sigue sirviendo a --plan.
+            stats.rows_in += len(batch)
+            if batch:
+                stats.batch_seconds.append(time.monotonic() - started)
+        return batch, classified
+
+    def drain_streamed() -> Iterator[Tuple[Sequence[Dict[str, str]], Dict[int, str], bool]]:
+        while True:
+            try:
+                row, category = streamed_items.get_nowait()
+            except queue.Empty:
+                return
+            yield [rows_by_number[row]], {row: category}, False
+
+    batches = iter([rows[start : start + tier.batch_size] for start in range(0, len(rows), tier.batch_size)])
+    with ThreadPoolExecutor(max_workers=tier.concurrency) as executor:
+        in_flight: Set[Future] = set()
+        while True:
+            limit = tier.concurrency
+            if budget is not None:
+                # No se envian mas lotes de los que el presupuesto de llamadas aun permite.
+                calls_left = budget.calls_left()
+                limit = limit if calls_left is None else min(limit, calls_left)
+            while not (budget is not None and budget.exhausted()) and len(in_flight) < limit:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                in_flight.add(executor.submit(run_batch, batch))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, timeout=0.2, return_when=FIRST_COMPLETED)
+            yield from drain_streamed()
+            for future in done:
+                yield (*future.result(), True)
+
+
+def print_tier_report(tier_stats: Sequence[TierStats], total_rows: int) -> None:
+    if not tier_stats:
+        return
+    print("Resumen por nivel:")
+    for index, stats in enumerate(tier_stats, start=1):
+        share = stats.rows_resolved / total_rows * 100 if total_rows else 0.0
+        print(
+            f"  {index}. {stats.model}: {stats.rows_in} filas recibidas, {stats.rows_resolved} resueltas "
+            f"({share:.1f}% del total) | {stats.calls} llamadas, {stats.failed_batches} lotes fallidos | "
+            f"lote p50 {percentile(stats.batch_seconds, 50):.1f}s, p95 {percentile(stats.batch_seconds, 95):.1f}s, "
+            f"tiempo del nivel {stats.wall_seconds:.1f}s | "
+            f"tokens entrada {stats.prompt_tokens}, salida {stats.completion_tokens}"
+            f"{format_hedge_summary(stats)}"
+        )
+
+
+def format_hedge_summary(stats: TierStats) -> str:
+    if not stats.hedges:
+        return ""
+    rate = stats.hedges / stats.calls * 100 if stats.calls else 0.0
+    return f" | duplicados {stats.hedges} ({rate:.1f}% de llamadas), ganaron {stats.hedge_wins}"
+
+
 def process_excel(
     input_path: Path,
     output_path: Path,
     sheet_name: Optional[str],
-    batch_size: int,
+    tiers: Sequence[ModelTier],
     retries: int,
     retry_base_sleep: float,
-    max_completion_tokens: int,
     autosave_every_batches: int,
     limit: Optional[int],
+    hedge: Optional[HedgePolicy] = None,
+    prefix_index: Optional[PrefixIndex] = None,
+    stream: bool = False,
+    telemetry_path: Optional[Path] = None,
+    priority_column: Optional[str] = None,
+    priorities: Optional[Dict[str, float]] = None,
+    budget: Optional[RunBudget] = None,
 ) -> None:
     load_dotenv_if_needed(Path(".env"))
     api_key = os.getenv("OPENAI_API_KEY", "").strip()
@@ -515,9 +1658,29 @@ def process_excel(
             }
         )
 
+    rows_to_classify = prioritize_rows(
+        lambda row, col: ws.cell(row=row, column=col).value,
+        headers,
+        rows_to_classify,
+        priority_column,
+        priorities,
+    )
     if limit is not None:
         rows_to_classify = rows_to_classify[:limit]
 
+    prefix_hits = 0
+    if prefix_index is not None:
+        remaining: List[Dict[str, str]] = []
+        for item in rows_to_classify:
+            category = prefix_index.predict(sku=item["sku"], reference=item["referencia"])
+            if category is None:
+                remaining.append(item)
+                continue
+            ws.cell(row=int(item["row"]), column=category_col, value=category)
+            prefix_hits += 1
+        rows_to_classify = remaining
+        print(f"Filas etiquetadas por indice de prefijos (sin IA): {prefix_hits}")
+
     if not rows_to_classify:
         wb.save(str(output_path))
         print("No hay filas pendientes por clasificar.")
@@ -530,38 +1693,90 @@ def process_excel(
     if already_categorized:
         print(f"Filas ya categorizadas detectadas y omitidas: {already_categorized}")
 
+    tier_stats: List[TierStats] = []
+    pending = rows_to_classify
+    position = {int(item["row"]): index for index, item in enumerate(rows_to_classify)}
+    escalated_rows: Set[int] = set()
+    written_rows: Set[int] = set()
     with tqdm(total=len(rows_to_classify), desc="Categorizando", unit="prod") as progress:
-        for start in range(0, len(rows_to_classify), batch_size):
-            batch = rows_to_classify[start : start + batch_size]
-            classified = classify_batch_resilient(
+        for tier_index, tier in enumerate(tiers):
+            if not pending or (budget is not None and budget.exhausted()):
+                break
+            is_last = tier_index == len(tiers) - 1
+            stats = TierStats(model=tier.model, budget=budget)
+            tier_stats.append(stats)
+            escalated: List[Dict[str, str]] = []
+            committed: Set[int] = set()
+            tier_started = time.monotonic()
+
+            for batch, classified, batch_done in iter_tier_batches(
                 api_key=api_key,
-                rows=batch,
+                tier=tier,
+                rows=pending,
+                is_last=is_last,
                 retries=retries,
                 retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
+                stats=stats,
                 progress=progress,
-            )
-
-            for item in batch:
-                row_number = int(item["row"])
-                category = classified.get(row_number)
-                if category is None:
-                    missing_count += 1
-                    category = keyword_fallback(
-                        sku=item.get("sku", ""),
-                        description=item.get("descripcion", ""),
-                        reference=item.get("referencia", ""),
-                    )
+                hedge=hedge,
+                stream=stream,
+                budget=budget,
+            ):
+                for item in batch:
+                    row_number = int(item["row"])
+                    if row_number in committed:
+                        continue
+                    category = classified.get(row_number)
+                    if category is None:
+                        if not is_last:
+                            escalated.append(item)
+                            continue
+                        missing_count += 1
+                        category = keyword_fallback(
+                            sku=item.get("sku", ""),
+                            description=item.get("descripcion", ""),
+                            reference=item.get("referencia", ""),
+                        )
+                    else:
+                        stats.rows_resolved += 1
+
+                    ws.cell(row=row_number, column=category_col, value=category)
+                    committed.add(row_number)
+                    progress.update(1)
+
+                if not batch_done:
+                    continue
+                processed_batches += 1
+                if autosave_every_batches > 0 and processed_batches % autosave_every_batches == 0:
+                    wb.save(str(output_path))
+                    progress.write(f"Progreso guardado: {progress.n}/{progress.total}")
 
-                ws.cell(row=row_number, column=category_col, value=category)
-                progress.update(1)
+            stats.wall_seconds = time.monotonic() - tier_started
+            written_rows.update(committed)
+            pending = sorted(escalated, key=lambda item: position[int(item["row"])])
+            escalated_rows.update(int(item["row"]) for item in pending)
+            if pending and not (budget is not None and budget.exhausted()):
+                progress.write(f"{tier.model}: {len(pending)} filas dudosas se escalan a {tiers[tier_index + 1].model}")
 
-            processed_batches += 1
-            if autosave_every_batches > 0 and processed_batches % autosave_every_batches == 0:
-                wb.save(str(output_path))
-                progress.write(f"Progreso guardado: {progress.n}/{progress.total}")
+        rows_left = progress.total - progress.n
+        escalated_left = len(escalated_rows - written_rows)
 
     wb.save(str(output_path))
+    if hedge is not None:
+        hedge.drain()
+    print_tier_report(tier_stats, total_rows=len(rows_to_classify))
+    if budget is not None and budget.reason is not None:
+        print(
+            f"Presupuesto agotado ({budget.reason}): {rows_left} filas quedan pendientes "
+            "para la proxima corrida."
+        )
+        if escalated_left:
+            print(
+                f"  {escalated_left} de ellas se escalaron como dudosas pero no llegaron a clasificarse; "
+                "la proxima corrida las empezara de nuevo desde el primer nivel."
+            )
+    if telemetry_path is not None:
+        append_telemetry(telemetry_path, "categoria", tier_stats)
 
     if missing_count:
         print(
@@ -582,6 +1797,12 @@ def process_excel_carroceria(
     max_completion_tokens: int,
     autosave_every_batches: int,
     limit: Optional[int],
+    model: str = MODEL_NAME,
+    hedge: Optional[HedgePolicy] = None,
+    telemetry_path: Optional[Path] = None,
+    priority_column: Optional[str] = None,
+    priorities: Optional[Dict[str, float]] = None,
+    budget: Optional[RunBudget] = None,
 ) -> None:
     load_dotenv_if_needed(Path(".env"))
     api_key = os.getenv("OPENAI_API_KEY", "").strip()
@@ -631,6 +1852,13 @@ def process_excel_carroceria(
             }
         )
 
+    rows_to_classify = prioritize_rows(
+        lambda row, col: ws.cell(row=row, column=col).value,
+        headers,
+        rows_to_classify,
+        priority_column,
+        priorities,
+    )
     if limit is not None:
         rows_to_classify = rows_to_classify[:limit]
 
@@ -646,22 +1874,39 @@ def process_excel_carroceria(
     if already_done:
         print(f"Filas ya identificadas y omitidas: {already_done}")
 
+    stats = TierStats(model=model, budget=budget)
     with tqdm(total=len(rows_to_classify), desc="Identificando Carroceria", unit="prod") as progress:
         for start in range(0, len(rows_to_classify), batch_size):
+            if budget is not None and budget.exhausted():
+                break
             batch = rows_to_classify[start : start + batch_size]
-            classified = classify_batch_carroceria_resilient(
-                api_key=api_key,
-                rows=batch,
-                retries=retries,
-                retry_base_sleep=retry_base_sleep,
-                max_completion_tokens=max_completion_tokens,
-                progress=progress,
-            )
+            batch_started = time.monotonic()
+            try:
+                classified = classify_batch_carroceria_resilient(
+                    api_key=api_key,
+                    rows=batch,
+                    retries=retries,
+                    retry_base_sleep=retry_base_sleep,
+                    max_completion_tokens=max_completion_tokens,
+                    progress=progress,
+                    model=model,
+                    stats=stats,
+                    hedge=hedge,
+                )
+            except BudgetExhausted as exc:
+                # Lo que no alcanzo a responderse queda pendiente en vez de ir a fallback.
+                classified = {row: bool(flag) for row, flag in exc.partial.items()}
+                batch = [item for item in batch if int(item["row"]) in classified]
+            stats.rows_in += len(batch)
+            if batch:
+                stats.batch_seconds.append(time.monotonic() - batch_started)
 
             for item in batch:
                 row_number = int(item["row"])
                 flag = classified.get(row_number)
-                if flag is None:
+                if flag is not None:
+                    stats.rows_resolved += 1
+                else:
                     missing_count += 1
                     flag = keyword_fallback_carroceria(
                         sku=item.get("sku", ""),
@@ -676,6 +1921,7 @@ def process_excel_carroceria(
             if autosave_every_batches > 0 and processed_batches % autosave_every_batches == 0:
                 wb.save(str(output_path))
                 progress.write(f"Progreso guardado: {progress.n}/{progress.total}")
+        rows_left = progress.total - progress.n
 
     wb.save(str(output_path))
     total_yes = 0
@@ -690,6 +1936,282 @@ def process_excel_carroceria(
         )
     else:
         print(f"Proceso completado. Archivo: {output_path}. Coincidencias Carroceria: {total_yes}")
+    if hedge is not None:
+        hedge.drain()
+    if stats.hedges:
+        print(f"Llamadas: {stats.calls}{format_hedge_summary(stats)}")
+    if budget is not None and budget.reason is not None:
+        print(
+            f"Presupuesto agotado ({budget.reason}): {rows_left} filas quedan pendientes "
+            "para la proxima corrida."
+        )
+    if telemetry_path is not None:
+        append_telemetry(telemetry_path, "carroceria", [stats])
+
+
+def format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {secs:02d}s"
+    return f"{secs}s"
+
+
+def plan_run(
+    input_path: Path,
+    output_path: Path,
+    sheet_name: Optional[str],
+    tiers: Sequence[ModelTier],
+    limit: Optional[int],
+    carroceria: bool,
+    prefix_index: Optional[PrefixIndex],
+    telemetry_path: Path,
+    rpm: Optional[float],
+    tpm: Optional[float],
+    priority_column: Optional[str] = None,
+    priorities: Optional[Dict[str, float]] = None,
+    budget: Optional[RunBudget] = None,
+) -> None:
+    """Recorre el Excel como una corrida real y estima lotes, tokens y tiempo sin llamar a la API."""
+    source_path = output_path if output_path.exists() else input_path
+    wb = load_workbook(filename=str(source_path), read_only=True)
+    ws = wb[sheet_name] if sheet_name else wb.active
+    rows_iter = ws.iter_rows(values_only=True)
+    headers = list(next(rows_iter, ()))
+    sku_idx, description_idx, reference_idx = resolve_header_indices(headers)
+
+    target_name = "es_carroceria" if carroceria else "categoria"
+    target_idx = None
+    for idx, col in enumerate(headers, start=1):
+        if normalize_text(str(col or "")) == target_name:
+            target_idx = idx
+            break
+
+    pending: List[Dict[str, str]] = []
+    values_by_row: Dict[int, Sequence[object]] = {}
+    already_done = 0
+    row_number = 1
+    for values in rows_iter:
+        row_number += 1
+
+        def cell(idx: Optional[int]) -> str:
+            if idx is None or idx - 1 >= len(values) or values[idx - 1] is None:
+                return ""
+            return str(values[idx - 1]).strip()
+
+        sku, description, reference = cell(sku_idx), cell(description_idx), cell(reference_idx)
+        if not sku and not description and not reference:
+            continue
+        if cell(target_idx):
+            already_done += 1
+            continue
+        pending.append({"row": row_number, "sku": sku, "descripcion": description, "referencia": reference})
+        if priority_column:
+            values_by_row[row_number] = values
+    wb.close()
+
+    def cell_value(row: int, col: int) -> object:
+        values = values_by_row.get(row, ())
+        return values[col - 1] if col - 1 < len(values) else None
+
+    pending = prioritize_rows(cell_value, headers, pending, priority_column, priorities)
+    total_pending = len(pending)
+    if limit is not None:
+        pending = pending[:limit]
+
+    prefix_hits = 0
+    if prefix_index is not None and not carroceria:
+        remaining = [item for item in pending if prefix_index.predict(item["sku"], item["referencia"]) is None]
+        prefix_hits = len(pending) - len(remaining)
+        pending = remaining
+
+    seen: Set[Tuple[str, str]] = set()
+    duplicates = 0
+    for item in pending:
+        key = (normalize_text(item["descripcion"]), normalize_code(item["referencia"]))
+        if key in seen:
+            duplicates += 1
+        seen.add(key)
+
+    telemetry = load_telemetry(telemetry_path, target_name)
+
+    print(f"Plan para {source_path} (sin llamadas a la API):")
+    print(f"  Filas ya procesadas: {already_done} | pendientes: {total_pending}")
+    if limit is not None:
+        print(f"  Limitadas por --limit a: {min(limit, total_pending)}")
+    if prefix_index is not None and not carroceria:
+        print(f"  Resueltas por indice de prefijos (sin IA): {prefix_hits}")
+    print(f"  Duplicados exactos (descripcion+referencia) entre las filas para IA: {duplicates}")
+    print(f"  Filas que irian a la IA: {len(pending)}")
+
+    total_calls = 0
+    total_input = 0
+    total_output = 0
+    total_seconds = 0.0
+    rows_in = len(pending)
+    for tier_index, tier in enumerate(tiers):
+        if rows_in <= 0:
+            break
+        is_last = tier_index == len(tiers) - 1
+        history = telemetry.get(tier.model)
+        tokens_per_row = (history and history.completion_tokens_per_row()) or DEFAULT_COMPLETION_TOKENS_PER_ROW
+        seconds_per_token = (history and history.seconds_per_completion_token()) or DEFAULT_SECONDS_PER_COMPLETION_TOKEN
+        overhead = 0.0 if history and history.seconds_per_completion_token() else DEFAULT_CALL_OVERHEAD_SECONDS
+
+        # Las filas de este nivel son las primeras `rows_in` pendientes: sirven de muestra para el prompt.
+        tier_rows = pending[:rows_in]
+        batches = [tier_rows[start : start + tier.batch_size] for start in range(0, rows_in, tier.batch_size)]
+        input_tokens = 0
+        output_tokens = 0
+        truncation_risk = 0
+        batch_seconds = 0.0
+        for batch in batches:
+            prompt = (
+                build_carroceria_prompt(batch)
+                if carroceria
+                else build_category_prompt(batch, ask_confidence=not is_last)
+            )
+            input_tokens += estimate_tokens(prompt)
+            expected_output = tokens_per_row * len(batch)
+            if expected_output > tier.max_completion_tokens:
+                truncation_risk += 1
+            batch_output = min(expected_output, tier.max_completion_tokens)
+            output_tokens += int(batch_output)
+            batch_seconds += overhead + batch_output * seconds_per_token
+
+        limits = {"latencia": batch_seconds / tier.concurrency}
+        if rpm:
+            limits["rpm"] = len(batches) / rpm * 60
+        if tpm:
+            limits["tpm"] = (input_tokens + output_tokens) / tpm * 60
+        bottleneck, seconds = max(limits.items(), key=lambda pair: pair[1])
+
+        source = f"telemetria de {history.runs} corridas" if history else "valores por defecto"
+        print(
+            f"  Nivel {tier_index + 1} {tier.model}: {rows_in} filas en {len(batches)} lotes de hasta "
+            f"{tier.batch_size}, concurrencia {tier.concurrency} ({source})"
+        )
+        print(
+            f"    tokens por lote: entrada ~{input_tokens // len(batches)}, salida ~{output_tokens // len(batches)} | "
+            f"total entrada ~{input_tokens}, salida ~{output_tokens}"
+        )
+        print(f"    tiempo estimado ~{format_duration(seconds)} (limita: {bottleneck})")
+        if truncation_risk:
+            print(
+                f"    Aviso: {truncation_risk} lotes podrian truncarse con tokens={tier.max_completion_tokens}; "
+                "baja el tamano de lote o sube el limite"
+            )
+
+        total_calls += len(batches)
+        total_input += input_tokens
+        total_output += output_tokens
+        total_seconds += seconds
+        if not is_last:
+            share = (history and history.resolved_share()) or DEFAULT_TIER_RESOLVED_SHARE
+            rows_in = int(math.ceil(rows_in * (1 - share)))
+
+    print(
+        f"  Total: ~{total_calls} llamadas, ~{total_input} tokens de entrada, ~{total_output} de salida, "
+        f"tiempo ~{format_duration(total_seconds)}"
+    )
+
+    if budget is not None:
+        # Proporcion de la corrida proyectada que cabe en cada limite; el menor es el que la detiene.
+        fractions = {}
+        if budget.max_seconds is not None and total_seconds:
+            fractions[f"--max-seconds {budget.max_seconds:g}"] = budget.max_seconds / total_seconds
+        if budget.max_calls is not None and total_calls:
+            fractions[f"--max-calls {budget.max_calls}"] = budget.max_calls / total_calls
+        if budget.max_tokens is not None and total_input + total_output:
+            fractions[f"--max-tokens {budget.max_tokens}"] = budget.max_tokens / (total_input + total_output)
+        stopper = min(fractions.items(), key=lambda pair: pair[1], default=None)
+        if stopper is None or stopper[1] >= 1.0:
+            print("  Presupuesto: alcanza para toda la corrida proyectada")
+        else:
+            print(
+                f"  Presupuesto: {stopper[0]} detendria la corrida hacia el {stopper[1] * 100:.0f}% "
+                f"(~{int(len(pending) * stopper[1])} de {len(pending)} filas para IA, en orden de prioridad)"
+            )
+
+
+def read_labelled_rows(path: Path, sheet_name: Optional[str]) -> List[Dict[str, str]]:
+    wb = load_workbook(filename=str(path), read_only=True)
+    ws = wb[sheet_name] if sheet_name else wb.active
+    rows_iter = ws.iter_rows(values_only=True)
+    headers = list(next(rows_iter, ()))
+    sku_idx, description_idx, reference_idx = resolve_header_indices(headers)
+
+    category_idx = None
+    for idx, col in enumerate(headers, start=1):
+        if normalize_text(str(col or "")) == "categoria":
+            category_idx = idx
+            break
+    if category_idx is None:
+        raise ValueError(f"{path} no tiene columna categoria")
+
+    out: List[Dict[str, str]] = []
+    for values in rows_iter:
+        def cell(idx: int) -> str:
+            return str(values[idx - 1] if idx - 1 < len(values) and values[idx - 1] is not None else "").strip()
+
+        category = canonicalize_category(cell(category_idx))
+        if category is None:
+            continue
+        out.append(
+            {
+                "sku": cell(sku_idx),
+                "descripcion": cell(description_idx),
+                "referencia": cell(reference_idx),
+                "categoria": category,
+            }
+        )
+    wb.close()
+    return out
+
+
+def learn_prefix_index(
+    train_paths: Sequence[Path],
+    sheet_name: Optional[str],
+    index_path: Path,
+    min_support: int,
+    min_purity: float,
+    holdout_path: Optional[Path],
+) -> None:
+    train_rows: List[Dict[str, str]] = []
+    for path in train_paths:
+        train_rows.extend(read_labelled_rows(path, sheet_name))
+    if not train_rows:
+        raise RuntimeError("Los archivos de entrenamiento no tienen filas con categoria valida")
+
+    index = PrefixIndex.build(train_rows, min_support=min_support, min_purity=min_purity)
+    index.save(index_path)
+    print(
+        f"Indice de prefijos guardado: {index_path} "
+        f"({len(train_rows)} filas de entrenamiento, {index.node_count()} nodos)"
+    )
+
+    if holdout_path is None:
+        return
+
+    holdout_rows = read_labelled_rows(holdout_path, sheet_name)
+    hits = 0
+    correct = 0
+    for row in holdout_rows:
+        predicted = index.predict(sku=row["sku"], reference=row["referencia"])
+        if predicted is None:
+            continue
+        hits += 1
+        if predicted == row["categoria"]:
+            correct += 1
+
+    hit_rate = hits / len(holdout_rows) * 100 if holdout_rows else 0.0
+    precision = correct / hits * 100 if hits else 0.0
+    print(
+        f"Evaluacion en {holdout_path}: {len(holdout_rows)} filas, "
+        f"{hits} etiquetadas por prefijo ({hit_rate:.1f}%), precision {precision:.1f}%"
+    )
 
 
 def parse_args() -> argparse.Namespace:
@@ -704,7 +2226,27 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Identifica solo si pertenece a Carroceria y escribe SI/NO en columna es_carroceria",
     )
+    parser.add_argument("--model", default=MODEL_NAME, help=f"Modelo de OpenAI (por defecto {MODEL_NAME})")
+    parser.add_argument(
+        "--tier",
+        action="append",
+        default=[],
+        metavar="MODELO[,batch=N][,concurrency=N][,tokens=N][,min_conf=F]",
+        help=(
+            "Nivel de la cascada de modelos (repetible, del mas rapido al mas fuerte). "
+            "Solo las filas dudosas de un nivel pasan al siguiente. Sin --tier se usa solo --model"
+        ),
+    )
     parser.add_argument("--batch-size", type=int, default=40, help="Cantidad de filas por llamada a IA")
+    parser.add_argument("--concurrency", type=int, default=1, help="Lotes en paralelo por nivel")
+    parser.add_argument(
+        "--min-confidence",
+        type=float,
+        help=(
+            "Confianza minima para aceptar una fila en niveles intermedios de la cascada "
+            f"(por defecto {DEFAULT_MIN_CONFIDENCE})"
+        ),
+    )
     parser.add_argument("--retries", type=int, default=4, help="Reintentos por lote")
     parser.add_argument("--retry-base-sleep", type=float, default=1.5, help="Espera base entre reintentos")
     parser.add_argument(
@@ -720,6 +2262,90 @@ def parse_args() -> argparse.Namespace:
         help="Guardar progreso cada N lotes (0 desactiva)",
     )
     parser.add_argument("--limit", type=int, help="Limita filas a procesar (util para pruebas)")
+    parser.add_argument(
+        "--priority-column",
+        help="Columna numerica del Excel: las filas pendientes se procesan de mayor a menor valor",
+    )
+    parser.add_argument(
+        "--priority-file",
+        help=(
+            "CSV/Excel con sku y un valor de prioridad (p. ej. unidades vendidas por sku: SaleItem "
+            "unido con Product.sku); se suma por sku y las filas se procesan de mayor a menor"
+        ),
+    )
+    parser.add_argument("--max-seconds", type=float, help="Deja de enviar lotes al pasar este tiempo")
+    parser.add_argument("--max-calls", type=int, help="Deja de enviar lotes al llegar a este numero de llamadas")
+    parser.add_argument("--max-tokens", type=int, help="Deja de enviar lotes al gastar estos tokens (entrada+salida)")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="No llama a la API: estima filas pendientes, lotes, tokens y tiempo de la corrida",
+    )
+    parser.add_argument("--rpm", type=float, help="Limite de peticiones por minuto para --plan")
+    parser.add_argument("--tpm", type=float, help="Limite de tokens por minuto para --plan")
+    parser.add_argument(
+        "--telemetry",
+        default=str(TELEMETRY_PATH),
+        help="Archivo JSONL donde cada corrida agrega sus estadisticas (y que --plan usa para estimar)",
+    )
+    parser.add_argument(
+        "--learn-prefixes",
+        metavar="INDICE_JSON",
+        help="Aprende un indice de prefijos sku/referencia desde --input (ya categorizado) y lo guarda aqui",
+    )
+    parser.add_argument(
+        "--train",
+        action="append",
+        default=[],
+        help="Excel categorizado adicional para --learn-prefixes (repetible)",
+    )
+    parser.add_argument("--holdout", help="Excel categorizado para medir aciertos y precision del indice")
+    parser.add_argument(
+        "--prefix-index",
+        help="Indice de prefijos (de --learn-prefixes) para etiquetar filas antes de llamar a la IA",
+    )
+    parser.add_argument(
+        "--prefix-min-support",
+        type=int,
+        help=(
+            f"Minimo de filas de entrenamiento que debe tener un prefijo para usarse "
+            f"(al aprender: {PREFIX_DEFAULT_MIN_SUPPORT}; al aplicar: el guardado en el indice, solo se puede subir)"
+        ),
+    )
+    parser.add_argument(
+        "--prefix-min-purity",
+        type=float,
+        help=(
+            f"Proporcion minima de la categoria dominante de un prefijo para usarlo "
+            f"(al aprender: {PREFIX_DEFAULT_MIN_PURITY}; al aplicar: la guardada en el indice)"
+        ),
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Recibe la respuesta en streaming: escribe cada fila en cuanto llega y, si se trunca, "
+            "continua solo con las filas sin respuesta (solo categorias)"
+        ),
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Si un lote tarda mas que el percentil observado, envia un duplicado y usa la primera respuesta",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=95.0,
+        help="Percentil de latencia observada tras el cual se envia el duplicado",
+    )
+    parser.add_argument("--hedge-max", type=int, default=20, help="Maximo de duplicados en toda la corrida")
+    parser.add_argument(
+        "--hedge-min-delay",
+        type=float,
+        default=2.0,
+        help="Espera minima en segundos antes de enviar un duplicado",
+    )
     return parser.parse_args()
 
 
@@ -731,6 +2357,68 @@ def main() -> int:
         print(f"No existe el archivo de entrada: {input_path}", file=sys.stderr)
         return 1
 
+    if args.prefix_min_support is not None and args.prefix_min_support < 1:
+        print("--prefix-min-support debe ser >= 1", file=sys.stderr)
+        return 1
+    if args.prefix_min_purity is not None and not 0.0 < args.prefix_min_purity <= 1.0:
+        print("--prefix-min-purity debe estar entre 0 y 1", file=sys.stderr)
+        return 1
+    if args.carroceria_only:
+        # Estas opciones solo existen en el modo de categorias; Carroceria procesa un lote a la vez.
+        unsupported = [
+            flag
+            for flag, used in (
+                ("--prefix-index", args.prefix_index),
+                ("--stream", args.stream),
+                ("--tier", args.tier),
+                ("--concurrency", args.concurrency != 1),
+                ("--min-confidence", args.min_confidence is not None),
+            )
+            if used
+        ]
+        if unsupported:
+            print(f"{', '.join(unsupported)} no se puede usar con --carroceria-only", file=sys.stderr)
+            return 1
+
+    if args.learn_prefixes:
+        train_paths = [input_path] + [Path(path) for path in args.train]
+        holdout_path = Path(args.holdout) if args.holdout else None
+        for path in train_paths + ([holdout_path] if holdout_path else []):
+            if not path.exists():
+                print(f"No existe el archivo: {path}", file=sys.stderr)
+                return 1
+        try:
+            learn_prefix_index(
+                train_paths=train_paths,
+                sheet_name=args.sheet,
+                index_path=Path(args.learn_prefixes),
+                min_support=(
+                    args.prefix_min_support
+                    if args.prefix_min_support is not None
+                    else PREFIX_DEFAULT_MIN_SUPPORT
+                ),
+                min_purity=(
+                    args.prefix_min_purity if args.prefix_min_purity is not None else PREFIX_DEFAULT_MIN_PURITY
+                ),
+                holdout_path=holdout_path,
+            )
+        except Exception as exc:
+            print(f"Error: {exc}", file=sys.stderr)
+            return 1
+        return 0
+
+    prefix_index: Optional[PrefixIndex] = None
+    if args.prefix_index:
+        try:
+            prefix_index = PrefixIndex.load(Path(args.prefix_index))
+        except (OSError, ValueError, KeyError) as exc:
+            print(f"No se pudo leer --prefix-index: {exc}", file=sys.stderr)
+            return 1
+        if args.prefix_min_support is not None:
+            prefix_index.min_support = max(prefix_index.min_support, args.prefix_min_support)
+        if args.prefix_min_purity is not None:
+            prefix_index.min_purity = args.prefix_min_purity
+
     if args.output:
         output_path = Path(args.output)
     elif args.carroceria_only:
@@ -747,9 +2435,92 @@ def main() -> int:
     if args.autosave_every_batches < 0:
         print("--autosave-every-batches debe ser >= 0", file=sys.stderr)
         return 1
+    if args.concurrency < 1:
+        print("--concurrency debe ser >= 1", file=sys.stderr)
+        return 1
+    if args.min_confidence is not None and not 0.0 <= args.min_confidence <= 1.0:
+        print("--min-confidence debe estar entre 0 y 1", file=sys.stderr)
+        return 1
+
+    if not 0.0 < args.hedge_percentile < 100.0:
+        print("--hedge-percentile debe estar entre 0 y 100", file=sys.stderr)
+        return 1
+    if args.hedge_max < 0:
+        print("--hedge-max debe ser >= 0", file=sys.stderr)
+        return 1
+    if args.hedge_min_delay < 0:
+        print("--hedge-min-delay debe ser >= 0", file=sys.stderr)
+        return 1
+
+    hedge: Optional[HedgePolicy] = None
+    if args.hedge:
+        hedge = HedgePolicy(
+            percentile=args.hedge_percentile,
+            max_hedges=args.hedge_max,
+            min_delay=args.hedge_min_delay,
+        )
+
+    default_tier = ModelTier(
+        model=args.model,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_completion_tokens=args.max_completion_tokens,
+        min_confidence=args.min_confidence if args.min_confidence is not None else DEFAULT_MIN_CONFIDENCE,
+    )
+    try:
+        tiers = [parse_tier_spec(spec, default_tier) for spec in args.tier] or [default_tier]
+    except ValueError as exc:
+        print(f"--tier: {exc}", file=sys.stderr)
+        return 1
+
+    if args.rpm is not None and args.rpm <= 0:
+        print("--rpm debe ser > 0", file=sys.stderr)
+        return 1
+    if args.tpm is not None and args.tpm <= 0:
+        print("--tpm debe ser > 0", file=sys.stderr)
+        return 1
+
+    telemetry_path = Path(args.telemetry)
+
+    for name in ("max_seconds", "max_calls", "max_tokens"):
+        value = getattr(args, name)
+        if value is not None and value <= 0:
+            print(f"--{name.replace('_', '-')} debe ser > 0", file=sys.stderr)
+            return 1
+    budget: Optional[RunBudget] = None
+    if args.max_seconds is not None or args.max_calls is not None or args.max_tokens is not None:
+        budget = RunBudget(max_seconds=args.max_seconds, max_calls=args.max_calls, max_tokens=args.max_tokens)
+
+    priorities: Optional[Dict[str, float]] = None
+    if args.priority_file:
+        try:
+            priorities = load_priority_file(Path(args.priority_file))
+        except (OSError, ValueError) as exc:
+            print(f"No se pudo leer --priority-file: {exc}", file=sys.stderr)
+            return 1
 
     try:
-        if args.carroceria_only:
+        if args.plan:
+            plan_run(
+                input_path=input_path,
+                output_path=output_path,
+                sheet_name=args.sheet,
+                tiers=(
+                    [ModelTier(args.model, args.batch_size, 1, args.max_completion_tokens)]
+                    if args.carroceria_only
+                    else tiers
+                ),
+                limit=args.limit,
+                carroceria=args.carroceria_only,
+                prefix_index=prefix_index,
+                telemetry_path=telemetry_path,
+                rpm=args.rpm,
+                tpm=args.tpm,
+                priority_column=args.priority_column,
+                priorities=priorities,
+                budget=budget,
+            )
+        elif args.carroceria_only:
             process_excel_carroceria(
                 input_path=input_path,
                 output_path=output_path,
@@ -760,18 +2531,30 @@ def main() -> int:
                 max_completion_tokens=args.max_completion_tokens,
                 autosave_every_batches=args.autosave_every_batches,
                 limit=args.limit,
+                model=args.model,
+                hedge=hedge,
+                telemetry_path=telemetry_path,
+                priority_column=args.priority_column,
+                priorities=priorities,
+                budget=budget,
             )
         else:
             process_excel(
                 input_path=input_path,
                 output_path=output_path,
                 sheet_name=args.sheet,
-                batch_size=args.batch_size,
+                tiers=tiers,
                 retries=args.retries,
                 retry_base_sleep=args.retry_base_sleep,
-                max_completion_tokens=args.max_completion_tokens,
                 autosave_every_batches=args.autosave_every_batches,
                 limit=args.limit,
+                hedge=hedge,
+                prefix_index=prefix_index,
+                stream=args.stream,
+                telemetry_path=telemetry_path,
+                priority_column=args.priority_column,
+                priorities=priorities,
+                budget=budget,
             )
     except Exception as exc:
         print(f"Error: {exc}", file=sys.stderr)